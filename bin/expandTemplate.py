@@ -5,111 +5,157 @@ Author: Doron Goldfarb, Environment Agency Austria
 """
 
 
+# Only the standard library is imported at module level, so that --help and
+# argument errors respond without loading prov/rdflib. The heavy imports happen
+# in main() once the arguments are known to be valid.
 import sys
-import prov
-import getopt
+import os
+import argparse
+import importlib.util
 import json
-try:
-	from provtemplates import provconv
-except ImportError as e:
-	try:
-		# Try if provconv.py is in current working directory
-		sys.path.append('.')
-		print ("Error loading provtemplates module with msg \"" + str(e) + "\", trying direct file import from cwd.")
-		import provconv
-	except ImportError as e2:
-		print ("Couldnt load provtemplate lib from file " + str(e2))
-
-def usage():
-	print ("Usage:")
-	print ("	python expandTemplate.py" )
-	print ("	mandatory --infile   = <Template File (PROV-RDF [ttl, trig, xml], PROV-xml, PROV-json)>")
-	print ("	-------------------------------------------")
-	print ("	mandatory --bindings = <Bindings File (PROV-RDF [ttl, trig, xml], PROV-xml, PROV-json)>")
-	print ("	alternat. --bindver3 --bindings=<Bindings File (JSON V3)>")
-	print ("	-------------------------------------------")
-	print ("		  --outfile  = <Bindings File (PROV-RDF [ttl, trig, xml], PROV-N, PROV-xml, PROV-json)>")
-	print ("		  --help  : Show this message")
-
-#make more formats available
-#template=prov.model.ProvDocument.deserialize(sys.argv[1], format="rdf", rdf_format="xml")
-try:
-	opts, args = getopt.getopt(sys.argv[1:], "hi:o:b:v3", ["help", "infile=", "outfile=", "bindings=", "verbose", "bindver3"])
-except getopt.GetoptError as err:
-	print (str(err))  # will print something like "option -a not recognized"
-	usage()
-	sys.exit(2)
-
-infile=None
-outfile=None
-bindings=None
-verbose=False
-v3=False
-
-for o, a in opts:
-	if o == "-v":
-		verbose = True
-	elif o in ("-h", "--help"):
-		usage()
-		sys.exit()
-	elif o in ("-o", "--outfile"):
-		outfile = a
-	elif o in ("-i", "--infile"):
-		infile = a
-	elif o in ("-b", "--bindings"):
-		bindings = a
-	elif o in ("-3", "--bindver3"):
-		v3=True
-	else:
-		assert False, "unhandled option"
-
-if not infile or not bindings:
-	usage()
-	sys.exit()
-
-#need to make this better, prov.read does not provide enough error info
-template=prov.read(infile)
-
-bindings_dict=None
-
-
-if v3:
-	v3_dict=json.load(open(bindings, "r"))
-	bindings=provconv.read_binding_v3(v3_dict)
-	bindings_dict=bindings["binddict"]
-	bindings_ns=bindings["namespaces"]
-	template=provconv.set_namespaces(bindings_ns, template)
-else:
-	#need to make this better, prov.read does not provide enough error info
-	bindings_doc=prov.read(bindings)
-	bindings_dict=provconv.read_binding(bindings_doc)
-	#print(bindings_doc.namespaces)
-	template=provconv.set_namespaces(bindings_doc.namespaces, template)
-
-#print bindings_dict
-
-#print bindings_doc.namespaces
-
-#Add template ns to output doc!!
-#print bindings_dict
-
-
-exp=provconv.instantiate_template(template, bindings_dict)
-
-for s in exp.bundles:
-	for r in s.records:
-		print (repr(r))
-
-outfilename=outfile
-toks=outfilename.split(".")
-frmt=toks[len(toks)-1]
-if frmt in ["rdf", "xml", "json", "ttl", "trig", "provn"]:
-	outfile=open(outfilename, "w")
-	if frmt in ["xml", "provn", "json"]:
-		outfile.write(exp.serialize(format=frmt))
-	else:	
-		if frmt == "rdf":
-			frmt="xml"
-		outfile.write(exp.serialize(format="rdf", rdf_format=frmt))
-	outfile.close()
+from concurrent.futures import ThreadPoolExecutor
+
+prov=None
+provconv=None
 
+def import_libs():
+	"""
+	import prov and provconv into the module namespace
+	"""
+	global prov, provconv
+	import prov
+	try:
+		from provtemplates import provconv
+	except ImportError as e:
+		try:
+			# Try if provconv.py is in current working directory
+			sys.path.append('.')
+			print ("Error loading provtemplates module with msg \"" + str(e) + "\", trying direct file import from cwd.")
+			import provconv
+		except ImportError as e2:
+			print ("Couldnt load provtemplate lib from file " + str(e2))
+
+# dump the expanded records to stdout, set by -v/--verbose
+VERBOSE=False
+
+# Known input extensions mapped to explicit prov.read format arguments. Naming the
+# format lets prov hand the file straight to the matching parser instead of trying
+# every registered deserializer in turn. ".xml" is ambiguous (PROV-XML vs RDF/XML)
+# and is left to prov's own format detection.
+READ_FORMATS={
+	"ttl"	: {"format" : "rdf", "rdf_format" : "turtle"},
+	"trig"	: {"format" : "rdf", "rdf_format" : "trig"},
+	"rdf"	: {"format" : "rdf", "rdf_format" : "xml"},
+	"json"	: {"format" : "json"},
+}
+
+# Output extensions mapped to ProvDocument.serialize arguments
+WRITE_FORMATS={
+	"xml"	: {"format" : "xml"},
+	"provn"	: {"format" : "provn"},
+	"json"	: {"format" : "json"},
+	"rdf"	: {"format" : "rdf", "rdf_format" : "xml"},
+	"ttl"	: {"format" : "rdf", "rdf_format" : "ttl"},
+	"trig"	: {"format" : "rdf", "rdf_format" : "trig"},
+	"jelly"	: {"format" : "rdf", "rdf_format" : "jelly"},
+}
+# formats written as bytes rather than text
+BINARY_FORMATS={"jelly"}
+
+def fast_prov_read(path):
+	"""
+	read a PROV document, dispatching on the file extension
+
+	Args:
+		path: template or bindings file
+	Returns:
+		ProvDocument
+	"""
+	ext=os.path.splitext(path)[1][1:].lower()
+	if ext not in READ_FORMATS:
+		return prov.read(path)
+	# pass the path, not an open stream: rdflib takes the document's base IRI from it,
+	# so relative IRIs resolve against the file's location rather than the cwd
+	return prov.read(path, **READ_FORMATS[ext])
+
+def load_json(path):
+	"""
+	load a JSON file
+
+	The standard json module is used on purpose: orjson turns integers wider than
+	64 bits into floats (or rejects them), so @value entries would lose precision.
+	"""
+	with open(path, "rb") as f:
+		return json.load(f)
+
+def read_bindings(path, v3):
+	"""
+	read a bindings file, either PROV or JSON V3
+
+	Args:
+		path: bindings file
+		v3: True for JSON V3 bindings
+	Returns:
+		(bindings dict, bindings namespaces)
+	"""
+	if v3:
+		bindings=provconv.read_binding_v3(load_json(path))
+		return bindings["binddict"], bindings["namespaces"]
+	bindings_doc=fast_prov_read(path)
+	return provconv.read_binding(bindings_doc), bindings_doc.namespaces
+
+PARSER=argparse.ArgumentParser(
+	prog="expandTemplate.py",
+	description="Expand a PROV template with a set of bindings, provconvert style")
+PARSER.add_argument("-i", "--infile", required=True,
+	help="Template File (PROV-RDF [ttl, trig, xml], PROV-xml, PROV-json)")
+PARSER.add_argument("-b", "--bindings", required=True,
+	help="Bindings File (PROV-RDF [ttl, trig, xml], PROV-xml, PROV-json), or JSON V3 with --bindver3")
+PARSER.add_argument("-3", "--bindver3", action="store_true",
+	help="bindings file is in JSON V3 format")
+PARSER.add_argument("-o", "--outfile",
+	help="Output File (PROV-RDF [ttl, trig, xml], PROV-N, PROV-xml, PROV-json, Jelly [jelly])")
+PARSER.add_argument("-v", "--verbose", action="store_true",
+	help="Print the expanded records")
+
+def main():
+	global VERBOSE
+	args=PARSER.parse_args()
+	VERBOSE=args.verbose
+
+	# fail before any parsing or expansion if .jelly output cannot be written.
+	# rdflib finds the Jelly serializer through pyjelly's plugin entry point,
+	# only check that the package is installed
+	if args.outfile and os.path.splitext(args.outfile)[1][1:].lower() == "jelly":
+		if importlib.util.find_spec("pyjelly") is None:
+			print ("Writing .jelly output requires the pyjelly package (pip install pyjelly[rdflib])")
+			sys.exit(1)
+
+	import_libs()
+
+	# template and bindings are independent, parse them concurrently
+	with ThreadPoolExecutor(max_workers=2) as ex:
+		f_template=ex.submit(fast_prov_read, args.infile)
+		f_bindings=ex.submit(read_bindings, args.bindings, args.bindver3)
+		template=f_template.result()
+		bindings_dict, bindings_ns=f_bindings.result()
+
+	# only add the bindings namespaces the template does not declare already
+	template_ns=frozenset(template.namespaces)
+	template=provconv.set_namespaces([ns for ns in bindings_ns if ns not in template_ns], template)
+
+	exp=provconv.instantiate_template(template, bindings_dict)
+
+	if VERBOSE:
+		sys.stdout.writelines(repr(r) + "\n" for s in exp.bundles for r in s.records)
+
+	outfile=args.outfile
+	if outfile:
+		frmt=os.path.splitext(outfile)[1][1:].lower()
+		if frmt in WRITE_FORMATS:
+			# serialize straight into the file rather than into an intermediate string
+			with open(outfile, "wb" if frmt in BINARY_FORMATS else "w") as f:
+				exp.serialize(f, **WRITE_FORMATS[frmt])
+
+if __name__ == "__main__":
+	main()
@@ -61,11 +61,13 @@ Package provides:
 import prov.model as prov
 import prov as provbase
 import six      
-from six.moves import reduce
 import itertools
+import operator
 import uuid
+import os
 import sys
 import collections
+import functools
 import logging
 
 
@@ -80,6 +82,46 @@ log.addHandler(handler)
 GLOBAL_UUID_DEF_NS_PREFIX="uuid"
 GLOBAL_UUID_DEF_NS=prov.Namespace(GLOBAL_UUID_DEF_NS_PREFIX, "urn:uuid:")
 
+#variables in this namespace get fresh uuids when declared as nodes, see match
+_VARGEN="vargen:"
+
+@functools.lru_cache(maxsize=4096)
+def _qualified_name(ns, localpart):
+	"""
+	memoized QualifiedName construction, binding files tend to repeat the same
+	prefixed names many times
+	"""
+	return prov.QualifiedName(ns, localpart)
+
+#tmpl:linked marks link groups; it is looked up for every record, so build it once
+_TMPL_NS=prov.Namespace("tmpl", "http://openprovenance.org/tmpl#")
+_TMPL_LINKED_QN=_qualified_name(_TMPL_NS, "linked")
+#tmpl:time carries the value for an unset prov:time formal attribute
+_TMPL_TIME_QN=_qualified_name(_TMPL_NS, "time")
+
+#instance dict override: tmpl:startTime, tmpl:endTime and tmpl:time stand for the prov attributes
+_PROV_NS=prov.Namespace("prov", "http://www.w3.org/ns/prov#")
+_TMPL_OVERRIDES={
+	"tmpl:startTime" : _qualified_name(_PROV_NS, "startTime"),
+	"tmpl:endTime" : _qualified_name(_PROV_NS, "endTime"),
+	"tmpl:time" : _qualified_name(_PROV_NS, "time"),
+}
+
+@functools.lru_cache(maxsize=4096)
+def _ident(uri):
+	"""
+	memoized Identifier construction for expanded node ids, keyed on the
+	string form so QualifiedNames with different prefixes stay apart
+	"""
+	return prov.Identifier(uri)
+
+def _uuid4_strs(n):
+	"""
+	n random (version 4) uuid strings, read from os.urandom in one call
+	"""
+	raw=os.urandom(16*n)
+	return [str(uuid.UUID(bytes=raw[i:i+16], version=4)) for i in range(0, 16*n, 16)]
+
 class UnknownRelationException(Exception):
 	pass
 
@@ -106,14 +148,13 @@ def set_namespaces(ns, prov_doc):
     '''    
     
  
+    add_namespace = prov_doc.add_namespace
     if isinstance(ns,dict):  
         for (sn,ln) in ns.items():
-    	    #print "Add NS " + sn + " " + ln 
-            prov_doc.add_namespace(sn,ln)         
+            add_namespace(sn,ln)         
     else:
         for nsi in ns:
-    	    #print "Add NS " + repr(nsi)  
-            prov_doc.add_namespace(nsi)     
+            add_namespace(nsi)     
     return prov_doc  
 
 def setEntry(rec, regNS):
@@ -124,7 +165,7 @@ def setEntry(rec, regNS):
 	
 	Args:
 		rec : a key value pair read from v3 bindings file
-		regNS: the namespaces read from the context section of the v3 bindings file
+		regNS: dict prefix -> namespace, read from the context section of the v3 bindings file
 	Returns:
 		"prov-ified" value, value as-is as fallback	
 
@@ -136,43 +177,38 @@ def setEntry(rec, regNS):
 	"""
 
 	out=rec
-	try:
-		if "@id" in rec:
-			toks=rec["@id"].split(":")
-			#print (repr(toks))
-			if len(toks) > 2:
-				raise BindingFileException( "Invalid Qualified Name " + rec["@id"] + " found in V3 Json Binding " +  repr(rec))
-				#print( "Invalid Qualified Name " + rec["@id"] + " found in V3 Json Binding" )
-			#for ns in regNS.get_registered_namespaces():
-			for ns in regNS:
-				#print (ns)
-				if ns.prefix==toks[0]:
-					#print ("HIT")
-					out=prov.QualifiedName(ns, toks[1])	
-		if "@value" in rec:
-			if "@type" in rec:
-				dt=rec["@type"]
-				if isinstance(rec["@type"], basestring):
-					dt=xsd_datype_to_prov_datatype(dt, regNS)
+	if "@id" in rec:
+		(prefix, sep, localpart)=rec["@id"].partition(":")
+		if ":" in localpart:
+			raise BindingFileException( "Invalid Qualified Name " + rec["@id"] + " found in V3 Json Binding " +  repr(rec))
+		ns=regNS.get(prefix)
+		if ns is not None:
+			if not sep:
+				raise BindingFileException("Error parsing " + repr(rec))
+			try:
+				out=_qualified_name(ns, localpart)
+			except Exception:
+				raise BindingFileException("Error parsing " + repr(rec))
+	if "@value" in rec:
+		if "@type" in rec:
+			dt=rec["@type"]
+			if isinstance(dt, six.string_types):
+				dt=xsd_datype_to_prov_datatype(dt, regNS)
+			try:
 				out=prov.Literal(rec["@value"], datatype=dt)	
-			else:
-				out=rec["@value"]
-	except:
-		raise BindingFileException("Error parsing " + repr(rec))
-		#pass
+			except Exception:
+				raise BindingFileException("Error parsing " + repr(rec))
+		else:
+			out=rec["@value"]
 	return out
 
 def xsd_datype_to_prov_datatype(instring, regNS):
 	#assume that in string is ALWAYS prefixed with namespace acro which MUST be present in namespace reg
 	toks=instring.split(":")
-	uri=""
-	for ns in regNS:
-		if  ns.prefix==toks[0]:
-			uri=ns.uri
-			break
-	if uri=="":
+	ns=regNS.get(toks[0])
+	if ns is None:
 		return None
-	fullstring=uri+toks[1]
+	fullstring=ns.uri+toks[1]
 	if fullstring=="http://www.w3.org/2001/XMLSchema#string":	
 		return prov.XSD_STRING
 	if fullstring=="http://www.w3.org/2001/XMLSchema#double":	
@@ -199,22 +235,13 @@ def read_binding_v3(v3_dict):
 	bindings_dict=dict()
 	namespaces=set()
 	if "context" in v3_dict:
-		#print v3_dict["context"]
-		for k in v3_dict["context"]:
-			namespaces.add(prov.Namespace(k, v3_dict["context"][k]))	
-	if "var" in v3_dict:	
-		for v in v3_dict["var"]:
-			val=list()
-			for rec in v3_dict["var"][v]:
-				#print(repr(val))
-				val.append(setEntry(rec, namespaces))
-			bindings_dict["var:"+v]=val
-	if "vargen" in v3_dict:	
-		for v in v3_dict["vargen"]:
-			val=list()
-			for rec in v3_dict["vargen"][v]:
-				val.append(setEntry(rec, namespaces))
-			bindings_dict["vargen:"+v]=val
+		for (prefix, uri) in v3_dict["context"].items():
+			namespaces.add(prov.Namespace(prefix, uri))
+	# lookup table for setEntry
+	ns_by_prefix={ns.prefix : ns for ns in namespaces}
+	for section in ("var", "vargen"):
+		for (v, recs) in v3_dict.get(section, {}).items():
+			bindings_dict[section+":"+v]=[setEntry(rec, ns_by_prefix) for rec in recs]
 	return({ "binddict" : bindings_dict,  "namespaces" : namespaces})	
 
 
@@ -267,14 +294,10 @@ def read_binding(bindings_doc):
 
 	def checkIdxRange(d):
 		# helper function for determining correct numbering of tmpl:value_X and .value_X_Y attrs
-		idx=d.keys()
-		#print (idx)
-		idx=sorted(idx)
-		#print (idx)
-		#print (min(idx))
-		#print (list(range(min(idx), max(idx) + 1)))
-
-		if min(idx) != 0 or idx != list(range(min(idx), max(idx) + 1)):
+		idx=sorted(d.keys())
+		# keys are distinct ints, so once sorted they form 0..n-1 exactly when
+		# the first is 0 and the last is n-1
+		if not idx or idx[0] != 0 or idx[-1] != len(idx) - 1:
 			raise BindingFileException("Invalid value sequence " + repr(d)  + " encountered in bindings file") 
 		return idx
 
@@ -395,6 +418,26 @@ def save_and_show(doc,filename):
     
     return doc1
 
+# relation types make_rel can create
+_REL_TYPES=frozenset([
+	prov.PROV_ATTRIBUTION,
+	prov.PROV_ASSOCIATION,
+	prov.PROV_DERIVATION,
+	prov.PROV_DELEGATION,
+	prov.PROV_GENERATION,
+	prov.PROV_INFLUENCE,
+	prov.PROV_COMMUNICATION,
+	prov.PROV_USAGE,
+	prov.PROV_START,
+	prov.PROV_END,
+	prov.PROV_INVALIDATION,
+	prov.PROV_MEMBERSHIP,
+	prov.PROV_ALTERNATE,
+	prov.PROV_SPECIALIZATION,
+])
+# relation types whose constructors only take formal attrs
+_REL_NO_KWARGS={prov.PROV_MEMBERSHIP, prov.PROV_ALTERNATE, prov.PROV_SPECIALIZATION}
+
 def make_rel(new_entity,rel,ident, formalattrs, otherAttrs):
 	"""
 	instantiate correct relation type with optional identifier and attributes
@@ -448,47 +491,17 @@ def make_rel(new_entity,rel,ident, formalattrs, otherAttrs):
 	#Membership	hadMember(c,e)	
 
 	"""
-	new_rel=None
-
-	#print (ident)
-	#print (formalattrs)
-
-	#handle expansion
-	#print (otherAttrs)
-
-	if rel.get_type() == prov.PROV_ATTRIBUTION:
-		new_rel = new_entity.wasAttributedTo(identifier=ident, other_attributes=otherAttrs, *formalattrs)
-	elif rel.get_type() == prov.PROV_ASSOCIATION:
-		new_rel = new_entity.wasAssociatedWith(identifier=ident, other_attributes=otherAttrs, *formalattrs)
-	elif rel.get_type() == prov.PROV_DERIVATION:
-		new_rel = new_entity.wasDerivedFrom(identifier=ident, other_attributes=otherAttrs, *formalattrs)
-	elif rel.get_type() == prov.PROV_DELEGATION:
-		new_rel = new_entity.actedOnBehalfOf(identifier=ident, other_attributes=otherAttrs, *formalattrs)
-	elif rel.get_type() == prov.PROV_GENERATION:
-		new_rel = new_entity.wasGeneratedBy(identifier=ident, other_attributes=otherAttrs, *formalattrs)
-	elif rel.get_type() == prov.PROV_INFLUENCE:
-		new_rel = new_entity.wasInfluencedBy(identifier=ident, other_attributes=otherAttrs, *formalattrs)
-	elif rel.get_type() == prov.PROV_COMMUNICATION:
-		new_rel = new_entity.wasInformedBy(identifier=ident, other_attributes=otherAttrs, *formalattrs)
-	elif rel.get_type() == prov.PROV_USAGE:
-		new_rel = new_entity.used(identifier=ident, other_attributes=otherAttrs, *formalattrs)
-	elif rel.get_type() == prov.PROV_START:
-		new_rel = new_entity.wasStartedBy(identifier=ident, other_attributes=otherAttrs, *formalattrs)
-	elif rel.get_type() == prov.PROV_END:
-		new_rel = new_entity.wasEndedBy(identifier=ident, other_attributes=otherAttrs, *formalattrs)
-	elif rel.get_type() == prov.PROV_INVALIDATION:
-		new_rel = new_entity.wasInvalidatedBy(identifier=ident, other_attributes=otherAttrs, *formalattrs)
-	# Thes following guys only have formal attrs
-	elif rel.get_type() == prov.PROV_MEMBERSHIP:
-		new_rel = new_entity.hadMember(*formalattrs)
-	elif rel.get_type() == prov.PROV_ALTERNATE:
-		new_rel = new_entity.alternateOf(*formalattrs)
-	elif rel.get_type() == prov.PROV_SPECIALIZATION:
-		new_rel = new_entity.specializationOf(*formalattrs)
+	t=rel.get_type()
+	if t not in _REL_TYPES:
+		raise UnknownRelationException("Relation  " + str(t) + " is not yet supported.")
+	# create the record directly from its formal attribute names, as the
+	# bundle convenience methods (wasGeneratedBy, used, ...) would do
+	attrs=list(zip(rel.FORMAL_ATTRIBUTES, formalattrs))
+	if t in _REL_NO_KWARGS:
+		# These guys only have formal attrs
+		new_entity.new_record(t, None, attrs)
 	else:
-		raise UnknownRelationException("Relation  " + rel.get_type() + " is not yet supported.")
-
-	
+		new_entity.new_record(t, ident, attrs, otherAttrs)
 
 def set_rel(new_entity,rel,idents, expAttr, linkedRelAttrs, otherAttrs):
 	'''
@@ -541,10 +554,10 @@ def set_rel(new_entity,rel,idents, expAttr, linkedRelAttrs, otherAttrs):
 			if len(idents) != len(relList):
 				raise IncorrectNumberOfBindingsForStatementVariableException("Wrong number of idents for expanded rel " + repr(rel)) 
 			getIdent=True
-		elif "vargen:" in idents._str and idents._str[:7]=="vargen:":
+		elif idents.namespace.prefix=="vargen":
 			#make uuid for each
 			makeUUID=True
-		elif "var:" in idents._str and idents._str[:4]=="var:":
+		elif idents.namespace.prefix=="var":
 			#make uuid for each
 			idents=None
 
@@ -553,29 +566,27 @@ def set_rel(new_entity,rel,idents, expAttr, linkedRelAttrs, otherAttrs):
 	attrlists=[]
 	indexlists=[]
 	#separate attribute values by group, but remember their original order in ilist
-	attrVisited=[]
+	expItems=list(expAttr.items())
+	attrVisited=set()
 	for g in linkedRelAttrs:
+		gset=set(g)
 		alist=[]
 		ilist=[]
-		cnt=0
-		for a in expAttr:
-			if a in g:
-				attrVisited.append(a)
-				alist.append(expAttr[a])
+		for (cnt, (a, vals)) in enumerate(expItems):
+			if a in gset:
+				attrVisited.add(a)
+				alist.append(vals)
 				ilist.append(cnt)
-			cnt+=1
 		attrlists.append(alist)
 		indexlists.append(ilist)
 	
 	#Some of the variables were not present in the linked groups.
 	if len(attrVisited)!=len(expAttr):
-		cnt=0
-		for a in expAttr:
+		for (cnt, (a, vals)) in enumerate(expItems):
 			if a not in attrVisited:
-				attrlists.append([expAttr[a]])
+				attrlists.append([vals])
 				indexlists.append([cnt])
-				attrVisited.append(a)
-			cnt+=1
+				attrVisited.add(a)
 	
 	
 	#print (repr(expAttr))
@@ -587,11 +598,17 @@ def set_rel(new_entity,rel,idents, expAttr, linkedRelAttrs, otherAttrs):
 	for a in attrlists:
 		outLists.append(zip(*a))
 
-	#taken from http://code.activestate.com/recipes/577932-flatten-arraytuple/
-	flatten = lambda arr: reduce(lambda x, y: ((isinstance(y, (list, tuple)) or x.append(y)) and x.extend(flatten(y))) or x, arr, [])
-
 	#we need this info to maintain the order of formal attributes
-	idx=flatten(indexlists)	
+	idx=[i for ilist in indexlists for i in ilist]
+	# idx maps grouped position -> formal position, invert it once so every
+	# expanded relation is put back into formal order by a single lookup
+	inv_idx=[0]*len(idx)
+	for (pos, orig) in enumerate(idx):
+		inv_idx[orig]=pos
+	if len(inv_idx)==1:
+		reorder=lambda out: (out[inv_idx[0]],)
+	else:
+		reorder=operator.itemgetter(*inv_idx)
 
 	log.debug("OUTLISTS")
 	log.debug(outLists)
@@ -600,6 +617,22 @@ def set_rel(new_entity,rel,idents, expAttr, linkedRelAttrs, otherAttrs):
 	relList=list(itertools.product(*outLists))
 	log.debug(relList)
 
+	# CONSTRUCT OTHER ATTRS SPEC FOR ALL RELS
+	# whether an attribute is shared by all expanded relations or bound per relation
+	# does not depend on the element, so check it once: (key, value, indexed)
+	otherAttrsSpec=[]
+	for k in otherAttrs:
+		log.debug("%r", otherAttrs[k])
+		oa_eles=1
+		if isinstance(otherAttrs[k], list):
+			oa_eles=len(otherAttrs[k])
+		if oa_eles!=1 and oa_eles < len(relList):
+			raise IncorrectNumberOfBindingsForStatementVariable("Attribute " + str(k) + " has incorrect number of bindings.")
+		otherAttrsSpec.append((k, otherAttrs[k], oa_eles!=1))
+
+	if makeUUID:
+		uids=_uuid4_strs(len(relList))
+
 	cnt=0
 	#iterate over cartesian product
 
@@ -607,46 +640,26 @@ def set_rel(new_entity,rel,idents, expAttr, linkedRelAttrs, otherAttrs):
 
 	for element in relList:
 		log.debug("MEH")
-		log.debug(repr(element))
-		log.debug(repr(otherAttrs))
-
+		log.debug("%r", element)
+		log.debug("%r", otherAttrs)
 
 		# CONSTRUCT OTHER ATTRS FOR THIS REL
-		rel_other_attrs=dict()
-		for k in otherAttrs:
-			log.debug(repr(otherAttrs[k]))
-			oa_eles=1
-			if isinstance(otherAttrs[k], list):
-				oa_eles=len(otherAttrs[k])
-			if oa_eles!=1 and oa_eles < len(relList):
-				raise IncorrectNumberOfBindingsForStatementVariable("Attribute " + str(k) + " has incorrect number of bindings.")
-			kval=None
-			if oa_eles==1:
-				kval=otherAttrs[k]
-			else:
-				kval=otherAttrs[k][cnt]
-			rel_other_attrs[k]=kval
-			
+		rel_other_attrs={k : (v[cnt] if indexed else v) for (k, v, indexed) in otherAttrsSpec}
 		
 		#print (element)
 		
-		out=flatten(element)
-
-		#print (out)
+		# element holds one tuple of values per link group
+		out=tuple(itertools.chain.from_iterable(element))
 
 		#reorder based on original ordering
-
-
-		# THIS IS THE ASSOC ORDER BUG
-		#outordered=[out[i] for i in idx]
-		outordered=[x for _,x in sorted(zip(idx, out))]
+		outordered=reorder(out)
 	
 
 		#create expanded relation	
 		if getIdent:
 			make_rel(new_entity, rel,idents[cnt], outordered, rel_other_attrs)
 		elif makeUUID:
-			make_rel(new_entity, rel, prov.QualifiedName(GLOBAL_UUID_DEF_NS, str(uuid.uuid4())), outordered, rel_other_attrs)
+			make_rel(new_entity, rel, prov.QualifiedName(GLOBAL_UUID_DEF_NS, uids[cnt]), outordered, rel_other_attrs)
 		else:
 			make_rel(new_entity, rel,idents, outordered, rel_other_attrs)
 		cnt+=1
@@ -681,9 +694,6 @@ def checkLinked(nodes, instance_dict):
 	
 	"""
 
-	"""#we need that for lookup"""
-	tmpl_linked_qn=prov.QualifiedName(prov.Namespace("tmpl", "http://openprovenance.org/tmpl#"), "linked")
- 
 	"""	
 	#make tmpl:linked sweep and determine order
 
@@ -698,54 +708,59 @@ def checkLinked(nodes, instance_dict):
 	linkedDict=dict()
 	linkedGroups=list()
 	for rec in nodes:
-		eid = rec.identifier
-		#print (repr(rec.attributes))
-		for attr in rec.attributes: 
-			if tmpl_linked_qn == attr[0]:
-				linkedDict[eid]=attr[1]
- 
+		#read-only scan: get_attribute would register the tmpl namespace on the
+		#template and leave an empty tmpl:linked entry on every record
+		for (name, value) in rec.attributes:
+			if name == _TMPL_LINKED_QN:
+				linkedDict[rec.identifier]=value
+
+	if not linkedDict:
+		# common case, no tmpl:linked at all: every variable forms its own group
+		# at offset 0 and the node order stays as is, no traversal or sort needed
+		numInstances=dict()
+		for rec in nodes:
+			eid=rec.identifier
+			if eid in numInstances:
+				continue
+			linkedGroups.append({eid : 0})
+			neid = match(eid._str,instance_dict, False)
+			if isinstance(neid, list):
+				numInstances[eid]=len(neid)
+			else:
+				numInstances[eid]=1
+		return { "nodes" : list(nodes), "numInstances" : numInstances, "linkedGroups" : linkedGroups}
+
 	"""# determine order, which of the variables is a "root", i.e only linked to by other vars"""
-	dependents=[]
-	roots=[]
-	intermediates=[]
-	for id in linkedDict:
-		if id not in dependents:
-			dependents.append(id)
-	for id in linkedDict:
-		if linkedDict[id] not in dependents:
-			roots.append(linkedDict[id])
-		else:
-			intermediates.append(linkedDict[id])
+	dependents=set(linkedDict)
+	# dict keeps the roots unique and in template order
+	roots=list(dict.fromkeys(v for v in linkedDict.values() if v not in dependents))
 
-	#print ("roots: " + repr(roots))
-	#print ("dependents: " + repr(dependents))
-	#print ("intermediates: " + repr(intermediates))
+	# adjacency list: linked-to variable -> variables linked to it
+	children=collections.defaultdict(list)
+	for (k, v) in linkedDict.items():
+		children[v].append(k)
 
-	def dfs_levels(node, links, level):
+	def dfs_levels(root, level):
 		"""
 		#helper function
-		#recursive depth first search to determine order of linked vars	
+		#iterative depth first search to determine order of linked vars	
+		#returns dict var -> level, the root having the passed level
 		"""
-		lower=dict()
-		#print (str(node) + " " + repr(lower))
-		for k in [k for k,v in links.items() if v == node]:
-			#print str(k) + " child of " + str(node)
-			ret=dfs_levels(k, links, level+1)
-			#print repr(ret)
-			if ret!=None:
-				lower.update(ret)
-		myval={node : level}
-		#print ("Appending : " + repr(myval))
-		lower.update(myval)
-	#print ("Returning : " + repr(lower))
-		return(lower)
+		levels=dict()
+		stack=[(root, level)]
+		while stack:
+			(node, lv)=stack.pop()
+			levels[node]=lv
+			for k in children[node]:
+				stack.append((k, lv+1))
+		return levels
 
 	numInstances=dict()
 	combRoot=dict()
 	#traverse from root
 	offset=0
 	for r in roots:
-		retval=dfs_levels(r, linkedDict, offset)
+		retval=dfs_levels(r, offset)
 		#print ("root: " + str(r))
 		#print (retval)
 		#get max rank
@@ -821,21 +836,17 @@ def prop_select(props,n):
 	'''
 	helper function to select individual values if dict value is a list
 	'''
+	# common case: nothing is bound per instance, all instances share the same attrs
+	if not any(isinstance(val,list) for val in props.values()):
+		return props
 	nprops = {}
-	#print("Props and n: ",props,n)
 	for key,val in props.items():
 		if isinstance(val,list):
-			#print ("---------------")
-			#print (len(val))
-			#
-			#BRUTE FORCE
-			#print (n)
-			#BRUTE FORCE
-			if len(val)==1:
-				n=0
-			if n >= len(val):
+			#a single value applies to all instances
+			idx = 0 if len(val)==1 else n
+			if idx >= len(val):
 				raise IncorrectNumberOfBindingsForStatementVariable("Attribute " + str(key) + " has incorrect number of bindings.")
-			nprops[key] = val[n]
+			nprops[key] = val[idx]
 		else:
 			nprops[key] = val 
 	return nprops        
@@ -878,7 +889,7 @@ def add_records(old_entity, new_entity, instance_dict):
 		elif rec.is_relation():
 			relations.append(rec)
 		else:
-			print("Warning: Unrecognized element type: ",rec)
+			log.warning("Unrecognized element type: %s", rec)
 
 	linkedInfo=checkLinked(nodes, instance_dict)
 	nodes_sorted=linkedInfo["nodes"]
@@ -894,58 +905,35 @@ def add_records(old_entity, new_entity, instance_dict):
 		#print eid._str
 		#dirty trick
 		neid = match(eid._str,instance_dict, True, numInstances[eid])
-		#print repr(neid)
-		#print repr(eid)
+		#a single generated id is expanded like a single bound value
+		if eid.namespace.prefix=="vargen" and isinstance(neid, list) and len(neid)==1:
+			neid=neid[0]
 		
 		#IF no match found then this var is unbound. In case of entities, this is always an error according to
 		# https://provenance.ecs.soton.ac.uk/prov-template/#errors
 
 		if neid == eid._str:
-			if "var:" in eid._str and eid._str[:4]=="var:":
+			if eid.namespace.prefix=="var":
 				raise UnboundMandatoryVariableException("Variable " + eid._str + " at mandatory position is unbound.")
 
 
 		#print(repr(instance_dict))
 		props_raw = attr_match(attr,instance_dict)
-		props=dict()
 		#eliminate tmpl:linked
-		for p in props_raw:
-			log.debug(type(p))
-			log.debug(repr(p))
-			if "tmpl:linked"!=p._str:
-				props[p]=props_raw[p]
+		props={p : v for (p, v) in props_raw.items() if p != _TMPL_LINKED_QN}
+		log.debug("%r", props)
 	
-		"""	
-		print ("-------------------")
-		print (repr(rec))
-		print (rec)
-		print (rec.get_asserted_types())
-		print (rec.get_type())
-		print ("######################")
-		print (repr(eid))
-		print (repr(neid))
-		print (repr(props))
-		print (repr(args))
-		print ("-------------------")
-		"""
 		#here we cann inject vargen things if there is a linked attr 
 
 
 		if isinstance(neid,list):
 			i = 0
+			otherAttr=None
 			for n in neid: 
 				oa=prop_select(props,i)
-				#print (repr(oa))
-				otherAttr=list()
-				for ea1 in oa:
-					#print (ea1)
-					#ea1_match=match(ea1[1], instance_dict, False)
-					if isinstance(oa[ea1], list):
-						for a in oa[ea1]:
-							otherAttr.append(tuple([ea1, a]))
-					else:
-						otherAttr.append(tuple([ea1, oa[ea1]]))
-			#print (n)
+				#attrs without per instance values are the same for all instances, build them once
+				if oa is not props or otherAttr is None:
+					otherAttr=[(k, v) for (k, vals) in oa.items() for v in (vals if isinstance(vals, list) else (vals,))]
 				newRec=prov.ProvRecord(rec.bundle, n,attributes=otherAttr)
 				newRec._prov_type=rec.get_type()
 				#print (newRec)
@@ -959,27 +947,35 @@ def add_records(old_entity, new_entity, instance_dict):
 			#print (numInstances)
 			#print (linkedGroups)
 			#print (repr(props))
-			newprop=list()
-			for p in props:
-				if isinstance(props[p], list):
-					for a in props[p]:
-						newprop.append(tuple([p, a]))
-				else:
-					newprop.append(tuple([p, props[p]]))
-			"""	
-			print (repr(newprop))
-			print (rec.bundle)
-			print (prov.Identifier(neid))
-			"""
+			newprop=[(k, v) for (k, vals) in props.items() for v in (vals if isinstance(vals, list) else (vals,))]
 			#DG NEW: WE MUST CORRECTLY EXPAND NESTED ATTRS HERE
 
 	
-			newRec=prov.ProvRecord(rec.bundle, prov.Identifier(neid),attributes=newprop)
+			newRec=prov.ProvRecord(rec.bundle, _ident(str(neid)),attributes=newprop)
 			newRec._prov_type=rec.get_type()
 			#print (newRec)
 			new_node = new_entity.add_record(newRec)
 			#new_node = new_entity.entity(prov.Identifier(neid),other_attributes=props)
 
+	# the same variables show up in many relations, resolve each one only once.
+	# No vargen ids are created here (node=False), so the results stay valid.
+	# The string form is part of the key since QualifiedNames compare by URI only.
+	resolved=dict()
+
+	# link group index of every variable, each variable belongs to exactly one group
+	group_of=dict()
+	for (gi, group) in enumerate(linkedGroups):
+		for var in group:
+			group_of[var]=gi
+
+	_match=match
+	def match_formal(value):
+		key=(value, str(value))
+		if key not in resolved:
+			m=_match(value, instance_dict, False)
+			resolved[key]=m if isinstance(m, list) else [m]
+		return resolved[key]
+
 	for rel in relations:
 		#print (rel)
 
@@ -989,138 +985,47 @@ def add_records(old_entity, new_entity, instance_dict):
 		#print (repr(rel))
 		#print (repr(rel.attributes))
 	
+		# both are properties rebuilt from the record on every access
+		formal_attributes=rel.formal_attributes
+		extra_attributes=rel.extra_attributes
+
 		#expand all possible formal attributes
-		linkedMatrix=collections.OrderedDict()
 		expAttr=collections.OrderedDict()
+		#we also want grouped relation attribute names, one list per link group
+		#involved in this relation, in link group order
+		relGroups=collections.defaultdict(list)
 
-		
-		
-		for fa1 in rel.formal_attributes:
-			linkedMatrix[fa1[0]]=collections.OrderedDict()
-			for fa2 in rel.formal_attributes:
-				linkedMatrix[fa1[0]][fa2[0]]=False
-				for group in linkedGroups:
-					if fa1[1] in group and fa2[1] in group: 
-						linkedMatrix[fa1[0]][fa2[0]]=True	
+		for fa1 in formal_attributes:
 			if fa1[1] != None:
-				expAttr[fa1[0]]=match(fa1[1], instance_dict, False)
-				if not isinstance(expAttr[fa1[0]], list):
-					expAttr[fa1[0]]=[expAttr[fa1[0]]]
+				expAttr[fa1[0]]=match_formal(fa1[1])
 			else:
 				#SPECUIAL CASE: prov:timea
-				if fa1[0]._str=="prov:time":
+				if fa1[0] == prov.PROV_ATTR_TIME:
 					expAttr[fa1[0]]=[None]
-					for ea1 in rel.extra_attributes:
-						if ea1[0]._str=="tmpl:time":
-							expAttr[fa1[0]]=match(ea1[1], instance_dict, False) 
-							if not isinstance(expAttr[fa1[0]], list):
-								expAttr[fa1[0]]=[expAttr[fa1[0]]]
+					for ea1 in extra_attributes:
+						if ea1[0] == _TMPL_TIME_QN:
+							expAttr[fa1[0]]=match_formal(ea1[1])
 							
 				else:
 					expAttr[fa1[0]]=[None]
+			gi=group_of.get(fa1[1])
+			if gi is not None:
+				relGroups[gi].append(fa1[0])
 
 		#dont forget extra attrs. these are not expanded but taken as is.
 		
-		
-		#we also want grouped relation attribute names
-		linkedRelAttrs=[]
-		# I think this is the problem, we need to distinguish if linkedGroups is just one or multiple groups
-		#print ("------")
-		#print (repr(linkedGroups))
-		#print (repr(rel.formal_attributes))
-		for group in linkedGroups:
-			lst=[]
-			for fa1 in rel.formal_attributes:
-				if fa1[1] in group:
-					lst.append(fa1[0])
-			if len(lst)>0:
-				linkedRelAttrs.append(lst)
-		#print (linkedRelAttrs)	
-
-		#print repr(linkedRelAttrs)
-
-		args = rel.args
-
-		linked=False
-		#print ("ITERATING THROUGH " + str(len(linkedGroups)) + " LINKEDGROUPS")
-		for group in linkedGroups:
-			#print ("------------")
-			#print (repr(group))
-			#print "IS " + str(args[0]) + " linked with  " + str(args[1])
-			if args[0] in group and args[1] in group:
-				#print repr(group)
-				#print str(args[0]) + " linked with  " + str(args[1])
-				linked=True
-				break
-
-		(nfirst,nsecond) = (match(args[0],instance_dict, False),match(args[1],instance_dict, False))     
+		linkedRelAttrs=[relGroups[gi] for gi in sorted(relGroups)]
+
 		log.debug("NEW REL")
-		log.debug((nfirst,nsecond))
 		#print(repr(instance_dict))
-		log.debug(repr(rel.extra_attributes))
-		relprops_raw = attr_match(rel.extra_attributes, instance_dict)
-		relprops=dict()
-		log.debug(repr(relprops_raw))
-		#eliminate tmpl:linked
-		for relp in relprops_raw:
-			log.debug(type(relp))
-			log.debug(repr(relp))
-			if "tmpl:linked"!=relp._str:
-				log.debug(repr(relprops_raw[relp]))
-				props[relp]=relprops_raw[relp]
-
-
-		# WE MOVE THAT TO THE POINT WHERE WE NOW HOW MANY RELS WE HAVE FOR THE VAR PAIR
-
-		##dont forget extra attrs
-		## we need to rerrange this into 
-		#otherAttr=list()
-		#for ea1 in props:
-		#	log.info(repr(ea1))
-		#	if ea1._str != "tmpl:time":
-		#		#DG NEW: #we can have multiple cases now
-		#		#if the other attr tuple is "fix"/"var", then ... it depends on the state of the link. If its projection
-		#
-		#		#should be relatively simple:
-		#		# if provided as simple list, then the attrs are expected to apply to all the connected instances
-		#
-		#		#if the other attr tuple is "var/var", its more complicated
-		#		
-		#		# imagine multiple cases
-		#
-		#		key_match=match(ea1[0], instance_dict, False)
-		#		va1_match=match(ea1[1], instance_dict, False)
-		#		if isinstance(key_match, list):
-		#			for a in ea1_match:
-		#				otherAttr.append(tuple([ea1[0], a]))
-		#		else:
-		#			otherAttr.append(tuple([ea1[0], ea1_match]))
-
-		##dont forget that the key can also be a variable
-		
-		
-		idents=match(rel.identifier, instance_dict, False)
-		"""
-		print ("rel -------------------------------")
-		print(repr(rel))
-		print ("idents -------------------------------")
-		print(repr(idents))
-		"""
-		log.debug(repr(idents))
-		"""
-		print ("expAttr -------------------------------")
-		print(repr(expAttr))
-		"""
-		log.debug(repr(expAttr))
-		"""
-		print ("linkedRelaTTRlinkedRelaTTRSS -------------------------------")
-		print(repr(linkedRelAttrs))
-		"""
-		log.debug(repr(linkedRelAttrs))
-		"""
-		print ("relprops_raw -------------------------------")
-		print(repr(relprops_raw))
-		"""
+		log.debug("%r", extra_attributes)
+		relprops_raw = attr_match(extra_attributes, instance_dict)
+		log.debug("%r", relprops_raw)
+
+		idents=_match(rel.identifier, instance_dict, False)
+		log.debug("%r", idents)
+		log.debug("%r", expAttr)
+		log.debug("%r", linkedRelAttrs)
 		#We need to check if instances are linked    
 		new_rel = set_rel(new_entity,rel,idents, expAttr,linkedRelAttrs, relprops_raw)        
 		#new_rel = set_rel(new_entity,rel,idents, expAttr,linkedRelAttrs, otherAttr)        
@@ -1138,43 +1043,30 @@ def match(eid,mdict, node, numEntries=1):
 	Returns:
 		meid: same as input or matching value for eid key in mdict
 	'''
-	adr=eid
-	if isinstance(adr,prov.QualifiedName):
-		lp = adr.localpart
-		ns = adr.namespace.prefix
-		adr=ns+":"+lp
+	if isinstance(eid,prov.QualifiedName):
+		# QualifiedName keeps its "prefix:localpart" form precomputed
+		adr=eid._str
+	elif isinstance(eid, six.string_types):
+		adr=eid
+	else:
+		# literals, times, None: the match dictionary is keyed by prefixed names only
+		return eid
 	#override: vargen found in entity declaration position: create a uuid
-	#print ("match " + repr(adr) + " with " + str(adr) + " red " + str(adr)[:7])
 	#not optimal, need ability to provide custom namespace
 
 	# FIX NAMESPACE FOR UUID!!!!!!!!
 
-	if node and "vargen:" in str(adr) and str(adr)[:7]=="vargen:":
-		#ret=None
-		for e in range(0,numEntries):
-			uid=str(uuid.uuid4())
-			if adr not in mdict:
-				ret=prov.QualifiedName(GLOBAL_UUID_DEF_NS, uid)
-				mdict[adr]=ret
-			else:
-				if not isinstance(mdict[adr], list):
-					tmp=list()
-					tmp.append(mdict[adr])
-					mdict[adr]=tmp
-					#tmp2=list()
-					#tmp2.append(ret)
-					#ret=tmp2
-				qn=prov.QualifiedName(GLOBAL_UUID_DEF_NS, uid)
-				mdict[adr].append(qn)
-				#ret.append(qn)
-		#return ret
-	if adr in mdict:
-		#print("Match: ",adr)
-		madr = mdict[adr]
-	else:
-		#print("No Match: ",adr)
-		madr = eid 
-	return madr
+	if node and numEntries>0 and adr.startswith(_VARGEN):
+		# generated ids are always kept as a list, ids from earlier calls are kept
+		ids=mdict.get(adr)
+		if ids is None:
+			ids=mdict[adr]=[]
+		elif not isinstance(ids, list):
+			ids=mdict[adr]=[ids]
+		ids.extend([prov.QualifiedName(GLOBAL_UUID_DEF_NS, uid) for uid in _uuid4_strs(numEntries)])
+		return ids
+	#unbound names come back as passed in
+	return mdict.get(adr, eid)
 
 def attr_match(attr_list,mdict):
 	'''
@@ -1189,45 +1081,26 @@ def attr_match(attr_list,mdict):
 		#TO DO: STARTTIME ENDTIME TIME
 
 	'''      
+	_match=match
 	p_dict = {}
 	for (pn,pv)  in attr_list:
-		#print ("pn: " + repr(pn) + " pv: " + repr(pv))
-		key_new = match(pn,mdict, False)
-		val_new = match(pv,mdict, False)
-		#for now, only take first list ele if npn_mew is list
-		#print ("npn_new: " + repr(npn_new))
-		key_list=list()
-		if isinstance(key_new, list):
-			key_list=key_new
-		else:
-			key_list.append(key_new)
-		#print ("npn_new: " + repr(npn_new))
-		#val_list=list()
-		#val_list.append(val_new)
-		val_list=list()
-		if isinstance(val_new, list):
-			val_list=val_new
-		else:
-			val_list.append(val_new)
+		key_new = _match(pn,mdict, False)
+		val_new = _match(pv,mdict, False)
+		key_list = key_new if isinstance(key_new, list) else [key_new]
+		val_list = val_new if isinstance(val_new, list) else [val_new]
 
 		if len(key_list)!=1 and len(key_list)!=len(val_list):
 			raise ValueError("Key and value list " + repr((pn,pv)) + " contains uneqal number of elements " + repr(key_list) + " " + repr(val_list))
 
-		for i in range(0,len(val_list)):
-			#res=match(val_list[i],mdict, False)
-			#print ("res: " + repr(res))
-			j=i
-			val = val_list[i]
-			if i>0 and len(key_list)==1:
-				j=0
-				val=p_dict[key_list[j]]
-				if i==1:
-					tmp=list()
-					tmp.append(val)
-					val=tmp
-				val.append(val_list[i])
-			p_dict[key_list[j]] = val
-		#print("Attr dict:",p_dict)
+		if len(key_list)==1:
+			#a single key collects all values, as list if there are several
+			if len(val_list)==1:
+				p_dict[key_list[0]] = val_list[0]
+			elif val_list:
+				p_dict[key_list[0]] = list(val_list)
+		else:
+			#keys and values are paired by position
+			p_dict.update(zip(key_list, val_list))
 	return p_dict 
 #---------------------------------------------------------------
 
@@ -1259,18 +1132,12 @@ def instantiate_template(prov_doc,instance_dict):
 
 
 	#instance dict override: replace tmpl:startTime and tmpl:endTime with prov:startTime and prov:endTime
-	instance_dict["tmpl:startTime"]=prov.QualifiedName(prov.Namespace("prov", "http://www.w3.org/ns/prov#"),"startTime")
-	instance_dict["tmpl:endTime"]=prov.QualifiedName(prov.Namespace("prov", "http://www.w3.org/ns/prov#"),"endTime")
-	instance_dict["tmpl:time"]=prov.QualifiedName(prov.Namespace("prov", "http://www.w3.org/ns/prov#"), "time")
-
-	#print repr(instance_dict)
+	instance_dict.update(_TMPL_OVERRIDES)
 
 	#CHECK FOR NAMESPACE FOR VARGEN UUID
-	for ns in prov_doc.namespaces:
-		if ns.prefix==GLOBAL_UUID_DEF_NS_PREFIX:
-			#print ("found namespace")
-			#uuid namespace defined in template? Use this one
-			GLOBAL_UUID_DEF_NS=ns
+	#uuid namespace defined in template? Use this one
+	ns_by_prefix={ns.prefix : ns for ns in prov_doc.namespaces}
+	GLOBAL_UUID_DEF_NS=ns_by_prefix.get(GLOBAL_UUID_DEF_NS_PREFIX, GLOBAL_UUID_DEF_NS)
 
 	new_doc = set_namespaces(prov_doc.namespaces,prov.ProvDocument()) 
 
@@ -1279,10 +1146,12 @@ def instantiate_template(prov_doc,instance_dict):
 
 	blist = list(prov_doc.bundles)
 
-	#print (repr(blist))
-	#print ("iterating bundles")
+	#bundles are expanded one after the other: ids generated for vargen variables
+	#are stored in instance_dict and shared with every later bundle and relation
 	for bundle in blist:       
 		id1=match(bundle.identifier, instance_dict, True)
+		if isinstance(id1, list) and len(id1)==1:
+			id1=id1[0]
 		#print (id1)
 		#print (repr(id1))
 		#print ("---")
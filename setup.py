@@ -1,5 +1,10 @@
+import io
+import os
 from setuptools import setup, find_packages 
 
+with io.open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'README.md'), encoding='utf-8') as readme:
+    long_description = readme.read()
+
 setup(
     name='EnvriProvTemplates',
     version='0.2.1',
@@ -9,5 +14,6 @@ setup(
     url="https://github.com/EnvriPlus-PROV/EnvriProvTemplates",
     scripts=['bin/expandTemplate.py'],
     license='Creative Commons Attribution-Noncommercial-Share Alike license',
-    long_description=open('README.md').read(),
+    long_description=long_description,
+    long_description_content_type='text/markdown',
 )